@@ -1,18 +1,24 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import time
+import threading
+import atexit
 import json
-import os
 import logging
 import hashlib
+import heapq
+import html
+import unicodedata
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict
-from PIL import Image
+from typing import Optional, List, Dict, Callable
 from pathlib import Path
-from collections import Counter
 from io import BytesIO
+from itertools import islice
+from functools import lru_cache
 try:
     from docx import Document
     from docx.shared import Pt, RGBColor
@@ -20,6 +26,11 @@ try:
     DOCX_AVAILABLE = True
 except ImportError:
     DOCX_AVAILABLE = False
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # ==========================================
 # LOGGING CONFIGURATION
@@ -45,15 +56,28 @@ RESPONSE_CACHE_FILE = DATA_DIR / "response_cache.json"
 # Cache configuration
 CACHE_MAX_SIZE = 100
 CACHE_TTL_HOURS = 168  # 1 week
+NOTION_CACHE_TTL = 600  # seconds, shared across all sessions
+NOTION_STALE_TTL = 86400  # seconds past the TTL that stale content may still be served
+NOTION_EDIT_TIME_RESOLUTION = 60  # last_edited_time is rounded to the minute
+NOTION_PAGE_SIZE = 100  # Notion API maximum
+NOTION_MAX_PAGES = 10
+# Differs on every Notion response, so it is left out of the body hash
+NOTION_REQUEST_ID_RE = re.compile(rb'"request_id"\s*:\s*"[^"]*"')
 
 # Ensure data directory exists
 DATA_DIR.mkdir(exist_ok=True)
 
-# Load favicon
-try:
-    favicon = Image.open("favicon.jpg")
-except:
-    favicon = "🎓"
+# Load favicon (decoded once per process, shared across reruns and users)
+@st.cache_resource(show_spinner=False)
+def load_favicon():
+    """Load the page icon, falling back to an emoji."""
+    try:
+        from PIL import Image  # only needed once per process
+        return Image.open(BASE_DIR / "favicon.jpeg")
+    except Exception:
+        return "🎓"
+
+favicon = load_favicon()
 
 st.set_page_config(
     page_title="ProfeBot - Spanish Year 1 Tutor",
@@ -138,8 +162,9 @@ hide_streamlit_style = """
 # ==========================================
 # CSS LOADING FROM FILES
 # ==========================================
+@st.cache_resource(show_spinner=False)
 def load_css_from_file(dark_mode: bool = False) -> str:
-    """Load CSS from external file based on theme."""
+    """Load CSS from external file based on theme (read once per theme)."""
     css_file = STYLES_DIR / ("dark.css" if dark_mode else "light.css")
     try:
         with open(css_file, "r", encoding="utf-8") as f:
@@ -150,20 +175,56 @@ def load_css_from_file(dark_mode: bool = False) -> str:
         logger.warning(f"CSS file not found: {css_file}, using fallback")
         return get_fallback_css(dark_mode)
 
-def get_fallback_css(dark_mode: bool = False) -> str:
-    """Minimal fallback CSS if files not found."""
-    bg = "#0d1117" if dark_mode else "#ffffff"
-    text = "#f0f6fc" if dark_mode else "#24292f"
-    return f"""
+# Minimal fallback CSS if files not found, one static template per theme
+FALLBACK_CSS = {
+    True: """
     <style>
-        .stApp {{ background-color: {bg}; color: {text}; }}
+        .stApp { background-color: #0d1117; color: #f0f6fc; }
     </style>
-    """
+    """,
+    False: """
+    <style>
+        .stApp { background-color: #ffffff; color: #24292f; }
+    </style>
+    """,
+}
+
+def get_fallback_css(dark_mode: bool = False) -> str:
+    """Minimal fallback CSS if files not found."""
+    return FALLBACK_CSS[bool(dark_mode)]
 
 # API Configuration
 MAX_RETRIES = 3
-RETRY_DELAY = 2
+RETRY_BACKOFF_FACTOR = 0.5  # exponential: 0.5s, 1s, 2s...
+RETRY_BACKOFF_MAX = 4  # seconds, caps any single backoff sleep
+RETRY_BACKOFF_JITTER = 0.5  # random extra seconds to avoid synchronized retries
+# 429 is left to the HKU API key rotation, which is faster than waiting it out;
+# the HKU adapter also ignores Retry-After, which would otherwise retry 429s anyway
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+# Notion has no second key to rotate to, so it also waits out 429 (honoring Retry-After)
+NOTION_RETRY_STATUS_CODES = RETRY_STATUS_CODES + (429,)
 REQUEST_TIMEOUT = 30
+HISTORY_WINDOW = 6  # previous messages sent to the model each turn
+HISTORY_MAX_CHARS = 12000  # ...and their combined size (~3k tokens); the newest is always kept
+HISTORY_FULL_MESSAGES = 2  # newest messages sent verbatim; older tutor replies are shortened
+HISTORY_OLD_REPLY_CHARS = 600  # characters kept from each older tutor reply
+MAX_THREAD_MESSAGES = 200  # messages kept per conversation
+CHAT_VISIBLE_TAIL = 20  # past messages rendered by default; older ones on request
+HISTORY_PANEL_ENABLED = False  # floating message history panel (temporarily disabled)
+HISTORY_PREVIEW_CHARS = 80  # characters shown per message in the history panel
+MAX_CONTEXT_CHARS = 16000  # cap on the Notion block embedded in the prompt
+NOTION_TOP_K_UNITS = 3  # units kept when the question matches specific units
+STREAM_FLUSH_INTERVAL = 0.08  # seconds between streamed UI updates
+STREAM_FLUSH_CHUNKS = 40  # ...or flush after this many deltas
+STORE_FLUSH_INTERVAL = 30  # seconds in-memory store changes are batched before writing to disk
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 10
+
+# Follow-up suggestions are appended by the model as "/// question" lines
+SUGGESTION_RE = re.compile(r'///\s*(.*)')
+SUGGESTION_STRIP_RE = re.compile(r'///.*')
+# Opening/closing lines of fenced code blocks (a backtick fence's info string cannot contain backticks)
+MARKDOWN_FENCE_RE = re.compile(r'^ {0,3}(`{3,}(?!.*`)|~{3,})(.*)$', re.MULTILINE)
 
 # Language configurations
 LANGUAGE_OPTIONS = {
@@ -234,67 +295,151 @@ DEPLOYMENT_ID = MODEL_FAST_ID
 HKU_API_KEY = KEY_FAST
 HKU_ENDPOINT = ENDPOINT_FAST
 
+# ==========================================
+# HTTP SESSIONS (CONNECTION POOLING)
+# ==========================================
+def build_pooled_adapter(status_codes: tuple = RETRY_STATUS_CODES, respect_retry_after: bool = True) -> HTTPAdapter:
+    """Connection-pooled adapter that retries transient failures with jittered backoff.
+
+    With respect_retry_after, urllib3 also retries 413/429/503 responses that
+    carry Retry-After, even when they are not in status_codes.
+    """
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        backoff_max=RETRY_BACKOFF_MAX,
+        backoff_jitter=RETRY_BACKOFF_JITTER,
+        status_forcelist=status_codes,
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=respect_retry_after,
+        raise_on_status=False  # hand the last 5xx back so callers can rotate keys
+    )
+    return HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=retry
+    )
+
+@st.cache_resource
+def get_notion_session() -> requests.Session:
+    """Shared Notion session so TLS connections are reused across reruns."""
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {NOTION_TOKEN}",
+        "Notion-Version": "2022-06-28",
+        "Content-Type": "application/json"
+    })
+    session.mount("https://", build_pooled_adapter(NOTION_RETRY_STATUS_CODES))
+    return session
+
+@st.cache_resource
+def get_hku_session() -> requests.Session:
+    """Shared HKU API session. The subscription key is sent per request for key rotation."""
+    session = requests.Session()
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Cache-Control": "no-cache"
+    })
+    # Rate-limited keys are rotated by call_ai_model, not waited out
+    session.mount("https://", build_pooled_adapter(respect_retry_after=False))
+    return session
+
 # ==========================================
 # HELPER FUNCTIONS
 # ==========================================
+def json_dumps_bytes(data) -> bytes:
+    """Serialize to UTF-8 JSON bytes, using orjson when available."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+def json_loads(data):
+    """Parse JSON from str or bytes, using orjson when available."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def create_persisted_store(data, save: Callable[[Dict], None]) -> Dict:
+    """In-memory store whose changes are written back with save() in batches (and at exit)."""
+    store = {"data": data, "save": save, "flush_pending": False, "lock": threading.Lock()}
+    atexit.register(flush_store, store)
+    return store
+
+def flush_store(store: Dict):
+    """Write a persisted store to disk."""
+    with store["lock"]:
+        store["flush_pending"] = False
+        store["save"](store["data"])
+
+def mark_store_dirty(store: Dict):
+    """Schedule one delayed flush for all changes in the window (call with the lock held)."""
+    if not store["flush_pending"]:
+        store["flush_pending"] = True
+        timer = threading.Timer(STORE_FLUSH_INTERVAL, flush_store, args=(store,))
+        timer.daemon = True
+        timer.start()
+
 def make_request_with_retry(
     method: str,
     url: str,
-    headers: dict,
+    headers: Optional[dict] = None,
     json_payload: Optional[dict] = None,
     params: Optional[dict] = None,
-    max_retries: int = MAX_RETRIES
+    session: Optional[requests.Session] = None,
+    stream: bool = False
 ) -> Optional[requests.Response]:
-    """Make HTTP request with automatic retry logic for transient errors."""
-    for attempt in range(max_retries):
-        try:
-            if method.upper() == "POST":
-                response = requests.post(
-                    url, 
-                    headers=headers, 
-                    json=json_payload, 
-                    params=params,
-                    timeout=REQUEST_TIMEOUT
-                )
-            elif method.upper() == "GET":
-                response = requests.get(
-                    url, 
-                    headers=headers, 
-                    params=params,
-                    timeout=REQUEST_TIMEOUT
-                )
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-            
-            if response.status_code in [502, 503, 504]:
-                if attempt < max_retries - 1:
-                    time.sleep(RETRY_DELAY * (attempt + 1))
-                    continue
+    """Make HTTP request; retries for transient errors are handled by the session adapter."""
+    http = session or requests
+    try:
+        if method.upper() == "POST":
+            body = None
+            if json_payload is not None:
+                body = json_dumps_bytes(json_payload)
+                headers = {**(headers or {}), "Content-Type": "application/json"}
+            return http.post(
+                url, 
+                headers=headers, 
+                data=body, 
+                params=params,
+                timeout=REQUEST_TIMEOUT,
+                stream=stream
+            )
+        elif method.upper() == "GET":
+            return http.get(
+                url, 
+                headers=headers, 
+                params=params,
+                timeout=REQUEST_TIMEOUT,
+                stream=stream
+            )
+        else:
+            raise ValueError(f"Unsupported HTTP method: {method}")
+        
+    except requests.exceptions.Timeout:
+        st.error(f"⏱️ Request timeout after {MAX_RETRIES} retries")
+        return None
             
-            return response
+    except requests.exceptions.ConnectionError as e:
+        st.error(f"🔌 Connection error after {MAX_RETRIES} retries")
+        logger.error(f"Connection error to {url}: {str(e)}")
+        return None
             
-        except requests.exceptions.Timeout:
-            if attempt < max_retries - 1:
-                time.sleep(RETRY_DELAY * (attempt + 1))
-                continue
-            else:
-                st.error(f"⏱️ Request timeout after {max_retries} attempts")
-                return None
-                
-        except requests.exceptions.ConnectionError as e:
-            if attempt < max_retries - 1:
-                time.sleep(RETRY_DELAY * (attempt + 1))
-                continue
-            else:
-                st.error(f"🔌 Connection error after {max_retries} attempts")
-                logger.error(f"Connection error to {url}: {str(e)}")
-                return None
-                
-        except Exception as e:
-            st.error(f"❌ Unexpected error: {str(e)}")
-            return None
-    
-    return None
+    except Exception as e:
+        st.error(f"❌ Unexpected error: {str(e)}")
+        return None
+
+def strip_suggestions(text: str) -> str:
+    """Remove /// suggestion lines; the substring check skips the regex for most messages."""
+    if "///" not in text:
+        return text.strip()
+    return SUGGESTION_STRIP_RE.sub('', text).strip()
+
+def get_message_text(message: Dict) -> str:
+    """Message text without /// suggestions (precomputed on append when available)."""
+    clean = message.get("clean")
+    if clean is None:
+        clean = strip_suggestions(message.get("content", ""))
+    return clean
 
 def generate_thread_title(first_message: str) -> str:
     """Generate a short title from the first user message."""
@@ -303,18 +448,19 @@ def generate_thread_title(first_message: str) -> str:
         return clean_msg[:30] + "..."
     return clean_msg
 
+LANGUAGE_INSTRUCTION_TEMPLATE = "All grammatical explanations, feedback, and answers to administrative questions MUST be in {}."
+LANGUAGE_INSTRUCTIONS = {
+    "English": LANGUAGE_INSTRUCTION_TEMPLATE.format("ENGLISH"),
+    "Cantonese": LANGUAGE_INSTRUCTION_TEMPLATE.format("CANTONESE (繁體中文 - 粵語)"),
+    "Mandarin": LANGUAGE_INSTRUCTION_TEMPLATE.format("MANDARIN (普通话 - 简体中文)"),
+}
+
+@lru_cache(maxsize=32)
 def get_language_instruction(language: str, custom_language: str = "") -> str:
     """Get language-specific instruction for the prompt."""
-    if language == "English":
-        return "All grammatical explanations, feedback, and answers to administrative questions MUST be in ENGLISH."
-    elif language == "Cantonese":
-        return "All grammatical explanations, feedback, and answers to administrative questions MUST be in CANTONESE (繁體中文 - 粵語)."
-    elif language == "Mandarin":
-        return "All grammatical explanations, feedback, and answers to administrative questions MUST be in MANDARIN (普通话 - 简体中文)."
-    elif language == "custom" and custom_language:
-        return f"All grammatical explanations, feedback, and answers to administrative questions MUST be in {custom_language.upper()}."
-    else:
-        return "All grammatical explanations, feedback, and answers to administrative questions MUST be in ENGLISH."
+    if language == "custom" and custom_language:
+        return LANGUAGE_INSTRUCTION_TEMPLATE.format(custom_language.upper())
+    return LANGUAGE_INSTRUCTIONS.get(language, LANGUAGE_INSTRUCTIONS["English"])
 
 # ==========================================
 # USER PROFILE & MEMORY SYSTEM
@@ -323,8 +469,7 @@ def load_user_profile() -> Dict:
     """Load user learning profile for personalization."""
     try:
         if USER_PROFILE_FILE.exists():
-            with open(USER_PROFILE_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            return json_loads(USER_PROFILE_FILE.read_bytes())
     except Exception as e:
         logger.error(f"Error loading user profile: {e}")
     return {
@@ -346,8 +491,9 @@ def save_user_profile(profile: Dict):
     """Save user learning profile."""
     try:
         profile["last_active"] = datetime.now().isoformat()
-        with open(USER_PROFILE_FILE, "w", encoding="utf-8") as f:
-            json.dump(profile, f, ensure_ascii=False, indent=2)
+        tmp_file = USER_PROFILE_FILE.with_suffix(".tmp")
+        tmp_file.write_bytes(json_dumps_bytes(profile))
+        tmp_file.replace(USER_PROFILE_FILE)
         logger.info("User profile saved")
     except Exception as e:
         logger.error(f"Error saving user profile: {e}")
@@ -501,22 +647,40 @@ def generate_cache_key(question: str, language: str) -> str:
     normalized = re.sub(r'[?!.,;:]', '', normalized)
     # Remove CMD_ prefixes for better matching
     normalized = re.sub(r'cmd_\w+:\s*', '', normalized)
-    cache_key = f"{normalized}|{language}"
+    # Entries expire when the course content changes
+    content_hash = get_notion_cache()["content_hash"] or b""
+    cache_key = f"{normalized}|{language}|{content_hash.hex()}"
     return hashlib.md5(cache_key.encode()).hexdigest()
 
+def save_response_cache(cache: Dict):
+    """Write the response cache to file (atomically)."""
+    try:
+        tmp_file = RESPONSE_CACHE_FILE.with_suffix(".tmp")
+        tmp_file.write_bytes(json_dumps_bytes(cache))
+        tmp_file.replace(RESPONSE_CACHE_FILE)
+    except Exception as e:
+        logger.error(f"Cache write error: {e}")
+
+@st.cache_resource
+def get_response_cache_store() -> Dict:
+    """Process-wide in-memory response cache, loaded once and written back in batches."""
+    cache = {}
+    try:
+        if RESPONSE_CACHE_FILE.exists():
+            cache = json_loads(RESPONSE_CACHE_FILE.read_bytes())
+    except Exception as e:
+        logger.error(f"Cache read error: {e}")
+    return create_persisted_store(cache, save_response_cache)
+
 def get_cached_response(question: str, language: str) -> Optional[str]:
     """Get cached response if available and not expired."""
     try:
-        if not RESPONSE_CACHE_FILE.exists():
-            return None
-        
         question_hash = generate_cache_key(question, language)
+        store = get_response_cache_store()
+        with store["lock"]:
+            entry = store["data"].get(question_hash)
         
-        with open(RESPONSE_CACHE_FILE, "r", encoding="utf-8") as f:
-            cache = json.load(f)
-        
-        if question_hash in cache:
-            entry = cache[question_hash]
+        if entry:
             cached_time = datetime.fromisoformat(entry["timestamp"])
             
             if datetime.now() - cached_time < timedelta(hours=CACHE_TTL_HOURS):
@@ -541,158 +705,408 @@ def cache_response(question: str, language: str, response: str):
         return
     
     try:
-        cache = {}
-        if RESPONSE_CACHE_FILE.exists():
-            with open(RESPONSE_CACHE_FILE, "r", encoding="utf-8") as f:
-                cache = json.load(f)
-        
         question_hash = generate_cache_key(question, language)
+        store = get_response_cache_store()
+        with store["lock"]:
+            cache = store["data"]
+            cache[question_hash] = {
+                "question_preview": question[:200],
+                "response": response,
+                "language": language,
+                "timestamp": datetime.now().isoformat(),
+                "hit_count": cache.get(question_hash, {}).get("hit_count", 0) + 1
+            }
         
-        cache[question_hash] = {
-            "question_preview": question[:200],
-            "response": response,
-            "language": language,
-            "timestamp": datetime.now().isoformat(),
-            "hit_count": cache.get(question_hash, {}).get("hit_count", 0) + 1
-        }
-        
-        # Prune old entries if cache is too large
-        if len(cache) > CACHE_MAX_SIZE:
-            # Sort by timestamp and keep most recent
-            sorted_entries = sorted(
-                cache.items(), 
-                key=lambda x: x[1].get("timestamp", ""),
-                reverse=True
-            )
-            cache = dict(sorted_entries[:CACHE_MAX_SIZE])
-        
-        with open(RESPONSE_CACHE_FILE, "w", encoding="utf-8") as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
+            # Prune old entries if cache is too large
+            if len(cache) > CACHE_MAX_SIZE:
+                # Keep the most recent entries (in place, the store owns this dict)
+                for stale_key, _ in heapq.nsmallest(
+                    len(cache) - CACHE_MAX_SIZE,
+                    cache.items(),
+                    key=lambda x: x[1].get("timestamp", "")
+                ):
+                    del cache[stale_key]
         
+            mark_store_dirty(store)
+    
         logger.info(f"Cached response for: {question[:50]}...")
-            
     except Exception as e:
         logger.error(f"Cache write error: {e}")
 
 def get_cache_stats() -> Dict:
     """Get cache statistics for display."""
     try:
-        if RESPONSE_CACHE_FILE.exists():
-            with open(RESPONSE_CACHE_FILE, "r", encoding="utf-8") as f:
-                cache = json.load(f)
-            
-            total_entries = len(cache)
-            total_hits = sum(entry.get("hit_count", 0) for entry in cache.values())
-            
+        store = get_response_cache_store()
+        with store["lock"]:
+            cache = store["data"]
             return {
-                "entries": total_entries,
-                "total_hits": total_hits,
+                "entries": len(cache),
+                "total_hits": sum(entry.get("hit_count", 0) for entry in cache.values()),
                 "max_size": CACHE_MAX_SIZE
             }
-    except:
-        pass
+    except Exception as e:
+        logger.error(f"Cache stats error: {e}")
     return {"entries": 0, "total_hits": 0, "max_size": CACHE_MAX_SIZE}
 
 # ==========================================
 # NOTION CONNECTION WITH CACHING
 # ==========================================
-@st.cache_data(ttl=3600)
-def get_weekly_content() -> str:
-    """Fetch active content from Notion database with caching."""
-    url = f"https://api.notion.com/v1/databases/{DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_TOKEN}",
-        "Notion-Version": "2022-06-28",
-        "Content-Type": "application/json"
+# Columns read for each unit: (field, Notion column, property type)
+NOTION_COLUMNS = (
+    ("name", "Nombre", "title"),
+    ("lexicon", "Léxico", "rich_text"),
+    ("grammar", "Gramática", "rich_text"),
+    ("tags", "Tags", "rich_text"),
+    ("exercises", "Ejercicios", "rich_text"),
+)
+
+def extract_notion_text(props: Dict, col_name: str, kind: str) -> str:
+    """Safely extract plain text from a Notion title/rich_text property."""
+    try:
+        items = (props.get(col_name) or {}).get(kind)
+        if not items:
+            return ""
+        # Rich text runs are contiguous fragments of one string; only "text" runs carry content
+        return "".join(item["text"]["content"] for item in items if "text" in item)
+    except Exception as e:
+        logger.error(f"Error extracting text from {col_name}: {e}")
+        return ""
+
+def format_unit_block(props: Dict) -> str:
+    """Format one Notion page as a unit block for the prompt ("" if it has no name)."""
+    unit = {
+        field: extract_notion_text(props, col_name, kind)
+        for field, col_name, kind in NOTION_COLUMNS
     }
+    name = unit["name"]
+    if not name:  # Only add unit if it has a name
+        return ""
+    logger.info(f"Loaded unit: {name}")
+    return f"""
+=== UNIT: {name} ===
+[TAGS]: {unit['tags'] or 'No tags listed'}
+[VOCABULARY]: {unit['lexicon'] or 'No vocabulary listed'}
+[GRAMMAR]: {unit['grammar'] or 'No grammar listed'}
+[APPROVED EXERCISES]: {unit['exercises'] or 'No exercises listed'}
+==============================
+"""
+
+@st.cache_data(ttl=NOTION_STALE_TTL, show_spinner=False)
+def get_notion_property_ids(_session: requests.Session) -> List[str]:
+    """Property ids of NOTION_COLUMNS, used to project query results (raises if unavailable)."""
+    url = f"https://api.notion.com/v1/databases/{DATABASE_ID}"
+    response = make_request_with_retry("GET", url, session=_session)
+    if not response or response.status_code != 200:
+        raise RuntimeError(f"Notion schema unavailable ({getattr(response, 'status_code', 'no response')})")
+    properties = json_loads(response.content).get("properties", {})
+    missing = [col_name for _, col_name, _ in NOTION_COLUMNS if col_name not in properties]
+    if missing:
+        raise RuntimeError(f"Notion columns not found: {missing}")
+    return [properties[col_name]["id"] for _, col_name, _ in NOTION_COLUMNS]
+
+def fetch_weekly_content(known_hash: Optional[bytes] = None) -> tuple:
+    """Fetch active content from Notion database (uncached).
+
+    Returns (context, content_hash). The hash covers the raw response bodies; if
+    it matches known_hash, the rows are not formatted again and context is None
+    so the caller keeps its current value.
+    """
+    url = f"https://api.notion.com/v1/databases/{DATABASE_ID}/query"
     payload = {
-        "filter": {"property": "Activo", "checkbox": {"equals": True}}
+        "filter": {"property": "Activo", "checkbox": {"equals": True}},
+        "page_size": NOTION_PAGE_SIZE
     }
-
-    response = make_request_with_retry("POST", url, headers, json_payload=payload)
-    
-    if not response:
-        return "❌ Failed to connect to Notion after multiple attempts."
+    session = get_notion_session()
     
-    if response.status_code != 200:
-        return f"❌ Notion API Error ({response.status_code}): {response.text[:200]}"
+    # Ask Notion for only the columns we read; unprojected rows still work if the
+    # schema lookup fails (it is retried on the next refresh, failures aren't cached)
+    params = None
+    try:
+        params = {"filter_properties": get_notion_property_ids(session)}
+    except Exception as e:
+        logger.warning(f"Fetching all Notion properties: {e}")
     
     try:
-        data = response.json()
-        results = data.get("results", [])
+        # Notion returns at most 100 rows per query; follow the cursor chain.
+        # Each cursor comes from the previous page, so pages are fetched in order.
+        results = []
+        body_hash = hashlib.blake2b(digest_size=16)
+        for _ in range(NOTION_MAX_PAGES):
+            response = make_request_with_retry("POST", url, json_payload=payload, params=params, session=session)
+            
+            if not response:
+                return "❌ Failed to connect to Notion after multiple attempts.", None
+            
+            if response.status_code != 200:
+                return f"❌ Notion API Error ({response.status_code}): {response.text[:200]}", None
+            
+            body_hash.update(NOTION_REQUEST_ID_RE.sub(b"", response.content))
+            # Parsed only for the cursor chain; formatting waits for the hash check
+            data = json_loads(response.content)
+            results.extend(data.get("results", []))
+            if not data.get("has_more") or not data.get("next_cursor"):
+                break
+            payload["start_cursor"] = data["next_cursor"]
+        else:
+            logger.warning(f"Notion query stopped after {NOTION_MAX_PAGES} pages")
+        
+        # Any edit to a projected property changes the body; metadata-only edits
+        # (or fresh signed file URLs) just cost one extra format pass
+        content_hash = body_hash.digest()
+        if known_hash is not None and content_hash == known_hash:
+            logger.info("Notion content unchanged, keeping cached context")
+            return None, content_hash
         
         if not results:
             logger.warning("No active units found in Notion database")
-            return "⚠️ No active units found in database."
+            return "⚠️ No active units found in database.", None
 
-        full_context = ""
-        for page in results:
-            props = page.get("properties", {})
-            
-            def get_text_safe(col_name: str) -> str:
-                """Safely extract text from Notion properties with validation."""
-                try:
-                    if col_name == "Nombre":
-                        prop_data = props.get("Nombre", {})
-                        items = prop_data.get("title", []) if prop_data else []
-                    else:
-                        prop_data = props.get(col_name, {})
-                        items = prop_data.get("rich_text", []) if prop_data else []
-                    
-                    if not items:
-                        logger.debug(f"No content found for column: {col_name}")
-                        return ""
-                    
-                    texts = []
-                    for item in items:
-                        if isinstance(item, dict):
-                            text_content = item.get("text", {})
-                            if isinstance(text_content, dict):
-                                content = text_content.get("content", "")
-                                if content:
-                                    texts.append(content)
-                    return " ".join(texts)
-                except Exception as e:
-                    logger.error(f"Error extracting text from {col_name}: {e}")
-                    return ""
-
-            name = get_text_safe("Nombre")
-            lexicon = get_text_safe("Léxico")
-            grammar = get_text_safe("Gramática")
-            tags = get_text_safe("Tags")
-            exercises = get_text_safe("Ejercicios")
-
-            if name:  # Only add unit if it has a name
-                full_context += f"""
-=== UNIT: {name} ===
-[TAGS]: {tags or 'No tags listed'}
-[VOCABULARY]: {lexicon or 'No vocabulary listed'}
-[GRAMMAR]: {grammar or 'No grammar listed'}
-[APPROVED EXERCISES]: {exercises or 'No exercises listed'}
-==============================
-"""
-                logger.info(f"Loaded unit: {name}")
-        
+        full_context = "".join(
+            format_unit_block(page.get("properties", {})) for page in results
+        )
         if not full_context:
-            return "⚠️ No valid units found in database."
-            
-        return full_context
+            return "⚠️ No valid units found in database.", None
+        
+        return full_context, content_hash
         
     except json.JSONDecodeError as e:
         logger.error(f"JSON decode error: {e}")
-        return f"❌ Error parsing Notion response: Invalid JSON"
+        return f"❌ Error parsing Notion response: Invalid JSON", None
     except Exception as e:
         logger.error(f"Error parsing Notion data: {e}")
-        return f"❌ Error parsing Notion data: {str(e)}"
+        return f"❌ Error parsing Notion data: {str(e)}", None
+
+def notion_time_to_epoch(value: str) -> Optional[float]:
+    """Convert a Notion ISO timestamp ("...Z") to epoch seconds (None if unparseable)."""
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+def probe_notion_last_edit() -> Optional[str]:
+    """Most recent last_edited_time in the database, from a one-row query (None on failure).
+
+    Unfiltered on purpose: toggling "Activo" off is an edit too, and would be
+    invisible to a query restricted to active units.
+    """
+    url = f"https://api.notion.com/v1/databases/{DATABASE_ID}/query"
+    payload = {
+        "sorts": [{"timestamp": "last_edited_time", "direction": "descending"}],
+        "page_size": 1
+    }
+    session = get_notion_session()
+    params = None
+    try:
+        params = {"filter_properties": get_notion_property_ids(session)[:1]}
+    except Exception:
+        pass
+    try:
+        response = make_request_with_retry("POST", url, json_payload=payload, params=params, session=session)
+        if not response or response.status_code != 200:
+            return None
+        results = json_loads(response.content).get("results", [])
+        return results[0].get("last_edited_time") if results else None
+    except Exception as e:
+        logger.warning(f"Notion change probe failed: {e}")
+        return None
+
+@st.cache_resource
+def get_notion_cache() -> Dict:
+    """Process-wide holder for the Notion context, shared by all sessions."""
+    return {
+        "value": None, "content_hash": None, "last_edit": None,
+        "fetched_at": 0.0, "full_fetched_at": 0.0,
+        "refreshing": False, "lock": threading.Lock()
+    }
+
+def refresh_notion_cache(cache: Dict) -> str:
+    """Fetch Notion content and store it, keeping the last good value on errors.
+
+    A one-row probe runs first; if the newest edit time is unchanged and safely
+    older than the last full fetch, the full query is skipped. Edit times are
+    minute-rounded, so an edit within a minute of that fetch could share its
+    timestamp and is always refetched. Archived pages don't show up in the probe,
+    so a full fetch still happens at least every NOTION_STALE_TTL.
+    """
+    try:
+        # A cold cache needs the full query anyway; don't delay it with a probe
+        last_edit = probe_notion_last_edit() if cache["value"] is not None else None
+        last_edit_epoch = notion_time_to_epoch(last_edit)
+        with cache["lock"]:
+            if (
+                cache["value"] is not None
+                and last_edit is not None
+                and last_edit == cache["last_edit"]
+                and last_edit_epoch is not None
+                and last_edit_epoch + NOTION_EDIT_TIME_RESOLUTION < cache["full_fetched_at"]
+                and time.time() - cache["full_fetched_at"] < NOTION_STALE_TTL
+            ):
+                cache["fetched_at"] = time.time()
+                return cache["value"]
+            known_hash = cache["content_hash"] if cache["value"] is not None else None
+        value, content_hash = fetch_weekly_content(known_hash)
+        with cache["lock"]:
+            now = time.time()
+            if value is None:
+                cache["fetched_at"] = cache["full_fetched_at"] = now
+                cache["last_edit"] = last_edit
+            elif "❌" not in value or cache["value"] is None:
+                cache["value"] = value
+                cache["content_hash"] = content_hash
+                cache["last_edit"] = last_edit if "❌" not in value else None
+                cache["fetched_at"] = cache["full_fetched_at"] = now
+            return cache["value"]
+    finally:
+        cache["refreshing"] = False
+
+def get_weekly_content() -> str:
+    """Get Notion content with stale-while-revalidate caching.
+
+    Fresh values are returned directly; stale ones are returned immediately while
+    a background thread refetches. Only a cold (or very stale) cache blocks.
+    """
+    cache = get_notion_cache()
+    with cache["lock"]:
+        value = cache["value"]
+        age = time.time() - cache["fetched_at"]
+        if value is not None and age < NOTION_CACHE_TTL:
+            return value
+        if value is not None and age < NOTION_CACHE_TTL + NOTION_STALE_TTL:
+            if not cache["refreshing"]:
+                cache["refreshing"] = True
+                threading.Thread(target=refresh_notion_cache, args=(cache,), daemon=True).start()
+            return value
+    return refresh_notion_cache(cache)
+
+def normalize_text(text: str) -> str:
+    """Lowercase and strip accents for keyword matching."""
+    normalized = unicodedata.normalize("NFD", text.lower())
+    return "".join(ch for ch in normalized if unicodedata.category(ch) != "Mn")
+
+# Words ignored when matching questions to units (includes the unit template labels)
+UNIT_MATCH_STOPWORDS = frozenset({
+    "the", "and", "for", "what", "how", "can", "you", "about", "with", "this", "that",
+    "que", "como", "por", "para", "una", "los", "las", "del", "con",
+    "unit", "tags", "vocabulary", "grammar", "approved", "exercises", "listed",
+})
+
+def extract_match_terms(text: str) -> set:
+    """Normalized words (3+ letters) used to score units against a question."""
+    return {
+        word for word in re.findall(r"\w+", normalize_text(text))
+        if len(word) >= 3 and word not in UNIT_MATCH_STOPWORDS
+    }
+
+@st.cache_data(show_spinner=False)
+def index_notion_units(context: str) -> List[tuple]:
+    """Split the Notion context into unit blocks paired with their term sets."""
+    units = [unit for unit in re.split(r'(?=\n=== UNIT: )', context) if unit.strip()]
+    return [(unit, frozenset(extract_match_terms(unit))) for unit in units]
+
+def select_relevant_units(context: str, user_message: str, top_k: int = NOTION_TOP_K_UNITS) -> str:
+    """Keep the top_k units sharing the most terms with the question.
+
+    Falls back to the full context for quick-action commands and for questions
+    that match no unit (e.g. "give me more examples"), so the model can still route.
+    """
+    if user_message.lstrip().upper().startswith("CMD_"):
+        return context
+    query_terms = extract_match_terms(user_message)
+    if not query_terms:
+        return context
+    indexed = index_notion_units(context)
+    if len(indexed) <= top_k:
+        return context
+    scores = [len(query_terms & terms) for _, terms in indexed]
+    if max(scores) == 0:
+        return context
+    best = sorted(range(len(indexed)), key=lambda i: scores[i], reverse=True)[:top_k]
+    keep = sorted(i for i in best if scores[i] > 0)  # preserve database order
+    logger.info(f"Selected {len(keep)}/{len(indexed)} units for the question")
+    return "".join(indexed[i][0] for i in keep)
+
+def trim_notion_context(context: str, max_chars: int = MAX_CONTEXT_CHARS) -> str:
+    """Keep whole units from the Notion context until the character budget is used."""
+    if len(context) <= max_chars:
+        return context
+    units = re.split(r'(?=\n=== UNIT: )', context)
+    kept = []
+    used = 0
+    for unit in units:
+        if kept and used + len(unit) > max_chars:
+            break
+        kept.append(unit)
+        used += len(unit)
+    logger.info(f"Trimmed Notion context to {len(kept)}/{len(units)} units ({used} chars)")
+    return "".join(kept)
 
 # ==========================================
 # AI CONNECTION - HYBRID ROUTER SYSTEM
 # ==========================================
+def read_streamed_completion(
+    response: requests.Response,
+    on_token: Callable[[str], None]
+) -> Optional[str]:
+    """Accumulate a server-sent-events chat completion, reporting progress via on_token.
+
+    Returns None for interrupted or unterminated streams so truncated replies are
+    never stored or cached. A body without any "data:" lines (a gateway that
+    ignored "stream": true) is parsed as a regular completion.
+    """
+    text = ""
+    saw_data = False
+    finished = False
+    other_lines = []
+    try:
+        with response:
+            for raw_line in response.iter_lines():
+                if not raw_line:
+                    continue
+                line = raw_line.decode("utf-8", errors="replace")
+                if not line.startswith("data:"):
+                    other_lines.append(line)
+                    continue
+                saw_data = True
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    finished = True
+                    break
+                try:
+                    chunk = json_loads(data)
+                except json.JSONDecodeError:
+                    logger.debug(f"Skipping malformed stream chunk: {data[:100]}")
+                    continue
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                if choices[0].get("finish_reason"):
+                    finished = True
+                delta = (choices[0].get("delta") or {}).get("content") or ""
+                if delta:
+                    text += delta
+                    on_token(text)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Stream interrupted after {len(text)} chars: {e}")
+        return None
+
+    if not saw_data:
+        try:
+            text = json_loads("\n".join(other_lines))["choices"][0]["message"]["content"] or ""
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logger.error(f"Unexpected non-streamed API response: {e}")
+            return None
+    elif not finished:
+        logger.error(f"Stream ended without completion marker after {len(text)} chars")
+        return None
+
+    return text or None
+
 def call_ai_model(
     messages: List[Dict],
     model_type: str = "fast",
     max_tokens: int = 1000,
-    temperature: float = 0.4
+    temperature: float = 0.4,
+    on_token: Optional[Callable[[str], None]] = None
 ) -> Optional[str]:
     """Call AI model with appropriate configuration for DeepSeek or Azure OpenAI.
     
@@ -701,6 +1115,7 @@ def call_ai_model(
         model_type: 'fast' for DeepSeek-V3
         max_tokens: Maximum tokens in response
         temperature: Response creativity (0-1)
+        on_token: If given, the response is streamed and this receives the text so far
     
     Returns:
         Response content string or None if failed
@@ -712,22 +1127,24 @@ def call_ai_model(
         "max_tokens": max_tokens,
         "temperature": temperature
     }
+    stream = on_token is not None
+    if stream:
+        payload["stream"] = True
     retriable_statuses = {429, 500, 502, 503, 504}
     response = None
     last_error = None
 
+    hku_session = get_hku_session()
     for api_key in API_KEYS:
-        headers = {
-            "Content-Type": "application/json",
-            "Cache-Control": "no-cache",
-            "Ocp-Apim-Subscription-Key": api_key
-        }
+        headers = {"Ocp-Apim-Subscription-Key": api_key}
         response = make_request_with_retry(
             "POST",
             ENDPOINT_FAST,
             headers,
             json_payload=payload,
-            params={"deployment-id": MODEL_FAST_ID}
+            params={"deployment-id": MODEL_FAST_ID},
+            session=hku_session,
+            stream=stream
         )
         if response and response.status_code == 200:
             break
@@ -747,9 +1164,11 @@ def call_ai_model(
         return None
 
     if response.status_code == 200:
+        if stream:
+            return read_streamed_completion(response, on_token)
         try:
-            return response.json()["choices"][0]["message"]["content"]
-        except (KeyError, IndexError) as e:
+            return json_loads(response.content)["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, ValueError) as e:
             logger.error(f"Unexpected API response format from {model_type}: {e}")
             return None
 
@@ -759,60 +1178,9 @@ def call_ai_model(
     return None
 
 
-def get_ai_response(user_message: str, notion_context: str, language: str, custom_language: str = "", conversation_history: List[Dict] = None) -> str:
-    """Get AI response from HKU API with error handling and conversation history.
-    
-    Args:
-        user_message: The current user message
-        notion_context: The course content from Notion
-        language: Preferred language for explanations
-        custom_language: Custom language if 'Other' selected
-        conversation_history: List of previous messages in the conversation
-    """
-    def normalize_text(text: str) -> str:
-        import unicodedata
-        normalized = unicodedata.normalize("NFD", text.lower())
-        return "".join(ch for ch in normalized if unicodedata.category(ch) != "Mn")
-
-    def is_admin_query(text: str) -> bool:
-        admin_keywords = [
-            "syllabus", "sillabus", "sylabus", "syllabi", "silabo", "programa", "temario", "guia docente",
-            "plan docente", "info general", "informacion general", "schedule",
-            "calendar", "calendario", "cronograma", "horario", "grading",
-            "grades", "nota", "notas", "assessment", "evaluacion", "evaluation",
-            "examen", "exam", "policy", "policies", "attendance", "asistencia",
-            "office hours", "tutorias", "consultas", "materials", "materiales",
-            "texto", "textbook", "libro", "course", "asignatura", "logistics",
-            "logistica", "administrative", "administrativo", "deadline",
-            "fecha", "entrega", "evaluacion continua", "criterios de evaluacion"
-        ]
-        text_norm = normalize_text(text)
-        return any(kw in text_norm for kw in admin_keywords)
-
-    def extract_info_general(context: str) -> str:
-        marker = "=== UNIT: Syllabus and Course administration ==="
-        if marker not in context:
-            return ""
-        start = context.find(marker)
-        end = context.find("==============================", start)
-        if end == -1:
-            return context[start:].strip()
-        return context[start:end + len("==============================")].strip()
-    
-    # Check cache first for simple, non-contextual queries
-    is_contextual = conversation_history and len(conversation_history) > 2
-    admin_query = is_admin_query(user_message)
-    if not is_contextual and not admin_query:
-        cached = get_cached_response(user_message, language)
-        if cached:
-            # Add cache indicator for router info
-            return f"{cached}\n<!--ROUTER_DEBUG:CACHED|Cache-->"
-    
-    language_instruction = get_language_instruction(language, custom_language)
-    user_context = get_user_context_for_prompt()
-    info_general_context = extract_info_general(notion_context) if admin_query else ""
-    
-    system_prompt = f"""
+# Static parts of the system prompt, built once at import. Only the language
+# instruction and the per-turn tail are interpolated per call.
+SYSTEM_PROMPT_ROLE = """
 [ROLE AND PROFILE]
 You are "ProfeBot", the official Spanish Tutor for Spanish Year 1 at the University of Hong Kong (HKU).
 
@@ -842,7 +1210,8 @@ You are "ProfeBot", the official Spanish Tutor for Spanish Year 1 at the Univers
 - Enthusiastic about Spanish without being overwhelming
 
 [⚠️ CRITICAL LANGUAGE PROTOCOL - MANDATORY ⚠️]
-The student's preferred language setting is: **{language_instruction}**
+The student's preferred language setting is: **"""
+SYSTEM_PROMPT_RULES = """**
 
 **ABSOLUTE RULES - NEVER VIOLATE:**
 1. ALL your text MUST be written in the STUDENT'S PREFERRED LANGUAGE, including:
@@ -881,7 +1250,6 @@ The student is enrolled in **SPAN1002**, so the course starts at **Unit 7**.
 - **Primary focus**: Units 7 and above.
 - **Foundations**: Units 0-6 can be used as review or to support explanations when needed.
 - Always check which units are currently "Active" in the database - these represent what the teacher has enabled for the current period.
-{user_context}
 
 [TASK GENERATION SYSTEM]
 When the user requests a TASK (CMD_TASKS), follow this protocol:
@@ -1044,26 +1412,114 @@ At the very end of your response, you MUST generate exactly 3 suggested follow-u
   /// How do I use [Word] in a sentence?
 
 --- ACTIVE CONTENT ---
-{notion_context}
-
---- SYLLABUS AND COURSE ADMINISTRATION (ADMIN ONLY) ---
-{info_general_context if info_general_context else "Syllabus and Course administration not found in Active Content."}
 """
 
+@lru_cache(maxsize=128)
+def build_system_prompt(
+    notion_context: str,
+    language_instruction: str,
+    user_context: str = "",
+    info_general_context: str = ""
+) -> str:
+    """Build the tutor system prompt (memoized in-process per context/language/profile).
+
+    Per-turn parts (selected units, admin excerpt, learner profile) come last so the
+    long instruction prefix stays byte-identical across turns and can be served
+    from the model provider's prefix cache.
+    """
+    admin_context = info_general_context or "Syllabus and Course administration not found in Active Content."
+    return "".join((
+        SYSTEM_PROMPT_ROLE,
+        language_instruction,
+        SYSTEM_PROMPT_RULES,
+        notion_context,
+        "\n\n--- SYLLABUS AND COURSE ADMINISTRATION (ADMIN ONLY) ---\n",
+        admin_context,
+        "\n",
+        user_context,
+        "\n",
+    ))
+
+def get_ai_response(user_message: str, notion_context: str, language: str, custom_language: str = "", conversation_history: List[Dict] = None, on_token: Optional[Callable[[str], None]] = None) -> str:
+    """Get AI response from HKU API with error handling and conversation history.
+    
+    Args:
+        user_message: The current user message
+        notion_context: The course content from Notion
+        language: Preferred language for explanations
+        custom_language: Custom language if 'Other' selected
+        conversation_history: List of previous messages in the conversation
+        on_token: Optional callback for streaming partial text to the UI
+    """
+    def is_admin_query(text: str) -> bool:
+        admin_keywords = [
+            "syllabus", "sillabus", "sylabus", "syllabi", "silabo", "programa", "temario", "guia docente",
+            "plan docente", "info general", "informacion general", "schedule",
+            "calendar", "calendario", "cronograma", "horario", "grading",
+            "grades", "nota", "notas", "assessment", "evaluacion", "evaluation",
+            "examen", "exam", "policy", "policies", "attendance", "asistencia",
+            "office hours", "tutorias", "consultas", "materials", "materiales",
+            "texto", "textbook", "libro", "course", "asignatura", "logistics",
+            "logistica", "administrative", "administrativo", "deadline",
+            "fecha", "entrega", "evaluacion continua", "criterios de evaluacion"
+        ]
+        text_norm = normalize_text(text)
+        return any(kw in text_norm for kw in admin_keywords)
+
+    def extract_info_general(context: str) -> str:
+        marker = "=== UNIT: Syllabus and Course administration ==="
+        if marker not in context:
+            return ""
+        start = context.find(marker)
+        end = context.find("==============================", start)
+        if end == -1:
+            return context[start:].strip()
+        return context[start:end + len("==============================")].strip()
+    
+    # Check cache first for simple, non-contextual queries
+    is_contextual = conversation_history and len(conversation_history) > 2
+    admin_query = is_admin_query(user_message)
+    if not is_contextual and not admin_query:
+        cached = get_cached_response(user_message, language)
+        if cached:
+            # Add cache indicator for router info
+            return f"{cached}\n<!--ROUTER_DEBUG:CACHED|Cache-->"
+    
+    language_instruction = get_language_instruction(language, custom_language)
+    user_context = get_user_context_for_prompt()
+    info_general_context = extract_info_general(notion_context) if admin_query else ""
+    
+    system_prompt = build_system_prompt(
+        trim_notion_context(select_relevant_units(notion_context, user_message)),
+        language_instruction,
+        user_context,
+        info_general_context
+    )
+
     # Build messages array with conversation history
     messages = [{"role": "system", "content": system_prompt}]
     
-    # Add conversation history (limit to last 10 messages to manage context window)
+    # Add conversation history (sliding window, bounded by count and size)
     if conversation_history:
-        # Filter out the suggestions from messages for cleaner context
-        for msg in conversation_history[-10:]:
+        history = []
+        budget = HISTORY_MAX_CHARS
+        # Walk newest first so the most recent turns win the budget
+        for position, msg in enumerate(reversed(conversation_history[-HISTORY_WINDOW:])):
             role = msg.get("role", "user")
             content = msg.get("content", "")
             # Clean out the /// suggestions from assistant messages
             if role == "assistant":
-                content = re.sub(r'///.*', '', content).strip()
-            if content:
-                messages.append({"role": role, "content": content})
+                content = get_message_text(msg)
+                # Older replies only need their gist; the student's own turns stay whole
+                if position >= HISTORY_FULL_MESSAGES and len(content) > HISTORY_OLD_REPLY_CHARS:
+                    content = content[:HISTORY_OLD_REPLY_CHARS].rstrip() + " […]"
+            if not content:
+                continue
+            if history and len(content) > budget:
+                break
+            budget -= len(content)
+            history.append({"role": role, "content": content})
+        messages.extend(reversed(history))
     
     # Add current user message
     messages.append({"role": "user", "content": user_message})
@@ -1072,7 +1528,7 @@ At the very end of your response, you MUST generate exactly 3 suggested follow-u
     
     # Single model (DeepSeek-V3) for all queries
     logger.info(f"Using model ({MODEL_FAST_ID}) for query")
-    result = call_ai_model(messages, model_type="fast", max_tokens=1200, temperature=0.4)
+    result = call_ai_model(messages, model_type="fast", max_tokens=1200, temperature=0.4, on_token=on_token)
     model_used = MODEL_FAST_ID
     complexity = "N/A"
     
@@ -1114,7 +1570,9 @@ def initialize_session_state():
                 "content": "Hello! 👋 I'm **ProfeBot**, your Spanish Year 1 tutor at HKU. I'm here to help you with Spanish grammar, vocabulary, exercises, and course questions. What would you like to learn today?"
             }],
             "created_at": datetime.now(),
-            "suggestions": []
+            "suggestions": [],
+            "user_message_count": 0,
+            "messages_appended": 1
         }
     
     if "message_count" not in st.session_state:
@@ -1165,12 +1623,18 @@ if "threads_loaded" not in st.session_state:
     st.session_state.threads_loaded = True
     # User starts with fresh session - no shared data
 
-# Apply custom CSS - try external files first, fallback to inline
-try:
-    st.markdown(load_css_from_file(st.session_state.dark_mode), unsafe_allow_html=True)
-except:
-    st.markdown(get_fallback_css(st.session_state.dark_mode), unsafe_allow_html=True)
-st.markdown(hide_streamlit_style, unsafe_allow_html=True)
+# Apply custom CSS - try external files first, fallback to inline.
+# Streamlit removes elements that are not re-emitted on a rerun, so the styles
+# are sent every time; they are only rebuilt when the theme actually changes and
+# stay byte-identical otherwise, which the frontend leaves untouched.
+if st.session_state.get("page_css_mode") != st.session_state.dark_mode:
+    try:
+        theme_css = load_css_from_file(st.session_state.dark_mode)
+    except:
+        theme_css = get_fallback_css(st.session_state.dark_mode)
+    st.session_state.page_css = theme_css + hide_streamlit_style
+    st.session_state.page_css_mode = st.session_state.dark_mode
+st.markdown(st.session_state.page_css, unsafe_allow_html=True)
 
 # ==========================================
 # EXPORT FUNCTIONS
@@ -1189,7 +1653,7 @@ def export_conversation_txt(messages: list) -> str:
     for msg in messages:
         role = "🧑 Student" if msg["role"] == "user" else "🤖 ProfeBot"
         # Clean out suggestion markers
-        content = re.sub(r'///.*', '', msg["content"]).strip()
+        content = get_message_text(msg)
         lines.append(f"{role}:")
         lines.append(content)
         lines.append("")
@@ -1218,7 +1682,7 @@ def export_conversation_md(messages: list) -> str:
         else:
             lines.append(f"### 🤖 ProfeBot")
         # Clean out suggestion markers
-        content = re.sub(r'///.*', '', msg["content"]).strip()
+        content = get_message_text(msg)
         lines.append(content)
         lines.append("")
     
@@ -1249,7 +1713,7 @@ def export_conversation_docx(messages: list) -> BytesIO:
     # Add messages
     for msg in messages:
         # Clean out suggestion markers
-        content = re.sub(r'///.*', '', msg["content"]).strip()
+        content = get_message_text(msg)
         
         if msg["role"] == "user":
             # User message header - HKU Blue
@@ -1290,6 +1754,29 @@ def export_conversation_docx(messages: list) -> BytesIO:
     buffer.seek(0)
     return buffer
 
+def get_conversation_exports() -> Dict:
+    """TXT/MD/DOCX exports of the current thread, rebuilt only when the thread or language changes."""
+    current_thread = get_current_thread()
+    messages = current_thread["messages"]
+    key = (
+        st.session_state.current_thread_id,
+        current_thread.get("messages_appended", len(messages)),
+        current_thread["title"],
+        st.session_state.preferred_language,
+    )
+    cached = st.session_state.get("export_cache")
+    if cached and cached["key"] == key:
+        return cached
+    docx_buffer = export_conversation_docx(messages) if DOCX_AVAILABLE else None
+    exports = {
+        "key": key,
+        "txt": export_conversation_txt(messages),
+        "md": export_conversation_md(messages),
+        "docx": docx_buffer.getvalue() if docx_buffer else None,
+    }
+    st.session_state.export_cache = exports
+    return exports
+
 # ==========================================
 # ANALYTICS FUNCTIONS
 # ==========================================
@@ -1297,8 +1784,7 @@ def load_analytics() -> Dict:
     """Load analytics data from file."""
     try:
         if ANALYTICS_FILE.exists():
-            with open(ANALYTICS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            return json_loads(ANALYTICS_FILE.read_bytes())
     except Exception as e:
         logger.error(f"Error loading analytics: {e}")
     return {
@@ -1312,107 +1798,128 @@ def load_analytics() -> Dict:
     }
 
 def save_analytics(analytics: Dict):
-    """Save analytics data to file."""
+    """Save analytics data to file (atomically, so a crash can't leave it truncated)."""
     try:
-        with open(ANALYTICS_FILE, "w", encoding="utf-8") as f:
-            json.dump(analytics, f, ensure_ascii=False, indent=2)
+        tmp_file = ANALYTICS_FILE.with_suffix(".tmp")
+        tmp_file.write_bytes(json_dumps_bytes(analytics))
+        tmp_file.replace(ANALYTICS_FILE)
         logger.info("Analytics saved")
     except Exception as e:
         logger.error(f"Error saving analytics: {e}")
 
+# Topic keywords are matched as substrings ("conjugat" covers conjugate/conjugation)
+ANALYTICS_TOPIC_KEYWORDS = {
+    "grammar": ["gramática", "grammar", "verb", "conjugat", "tense"],
+    "vocabulary": ["vocabulario", "vocabulary", "word", "palabra", "meaning"],
+    "pronunciation": ["pronuncia", "sound", "accent"],
+    "culture": ["cultura", "culture", "spain", "españa", "mexico"],
+    "exercises": ["ejercicio", "exercise", "practice", "quiz", "task"]
+}
+ANALYTICS_TOPIC_RES = {
+    topic: re.compile("|".join(map(re.escape, keywords)))
+    for topic, keywords in ANALYTICS_TOPIC_KEYWORDS.items()
+}
+ANALYTICS_UNIT_RE = re.compile(r'\b(?:unit|unidad)\s*(\d{1,2})\b')
+ANALYTICS_MAX_UNIT = 14
+
+@st.cache_resource
+def get_analytics_store() -> Dict:
+    """Process-wide in-memory analytics; changes are written to disk in batches."""
+    return create_persisted_store(load_analytics(), save_analytics)
+
 def track_message(user_message: str, response_time: float = 0):
     """Track a user message for analytics."""
-    analytics = load_analytics()
-    
-    # Update total messages
-    analytics["total_messages"] = analytics.get("total_messages", 0) + 1
-    
-    # Track daily usage
-    today = datetime.now().strftime("%Y-%m-%d")
-    if "daily_usage" not in analytics:
-        analytics["daily_usage"] = {}
-    analytics["daily_usage"][today] = analytics["daily_usage"].get(today, 0) + 1
-    
-    # Track response time (keep last 100)
-    if response_time > 0:
-        if "response_times" not in analytics:
-            analytics["response_times"] = []
-        analytics["response_times"].append(response_time)
-        analytics["response_times"] = analytics["response_times"][-100:]
-    
-    # Detect topic keywords
-    topics = {
-        "grammar": ["gramática", "grammar", "verb", "conjugat", "tense"],
-        "vocabulary": ["vocabulario", "vocabulary", "word", "palabra", "meaning"],
-        "pronunciation": ["pronuncia", "sound", "accent"],
-        "culture": ["cultura", "culture", "spain", "españa", "mexico"],
-        "exercises": ["ejercicio", "exercise", "practice", "quiz", "task"]
-    }
-    
-    message_lower = user_message.lower()
-    for topic, keywords in topics.items():
-        if any(kw in message_lower for kw in keywords):
-            if "questions_by_topic" not in analytics:
-                analytics["questions_by_topic"] = {}
-            analytics["questions_by_topic"][topic] = analytics["questions_by_topic"].get(topic, 0) + 1
-    
-    # Detect unit references
-    for i in range(1, 15):
-        if f"unit {i}" in message_lower or f"unidad {i}" in message_lower:
-            if "questions_by_unit" not in analytics:
-                analytics["questions_by_unit"] = {}
-            unit_key = f"Unit {i}"
-            analytics["questions_by_unit"][unit_key] = analytics["questions_by_unit"].get(unit_key, 0) + 1
-    
-    save_analytics(analytics)
+    store = get_analytics_store()
+    with store["lock"]:
+        analytics = store["data"]
+        
+        # Update total messages
+        analytics["total_messages"] = analytics.get("total_messages", 0) + 1
+        
+        # Track daily usage
+        today = datetime.now().strftime("%Y-%m-%d")
+        if "daily_usage" not in analytics:
+            analytics["daily_usage"] = {}
+        analytics["daily_usage"][today] = analytics["daily_usage"].get(today, 0) + 1
+        
+        # Track response time (keep last 100)
+        if response_time > 0:
+            if "response_times" not in analytics:
+                analytics["response_times"] = []
+            analytics["response_times"].append(response_time)
+            del analytics["response_times"][:-100]
+        
+        # Detect topic keywords
+        message_lower = user_message.lower()
+        for topic, topic_re in ANALYTICS_TOPIC_RES.items():
+            if topic_re.search(message_lower):
+                if "questions_by_topic" not in analytics:
+                    analytics["questions_by_topic"] = {}
+                analytics["questions_by_topic"][topic] = analytics["questions_by_topic"].get(topic, 0) + 1
+        
+        # Detect unit references (each unit counted once per message)
+        units = {int(n) for n in ANALYTICS_UNIT_RE.findall(message_lower)}
+        for i in sorted(units):
+            if 1 <= i <= ANALYTICS_MAX_UNIT:
+                if "questions_by_unit" not in analytics:
+                    analytics["questions_by_unit"] = {}
+                unit_key = f"Unit {i}"
+                analytics["questions_by_unit"][unit_key] = analytics["questions_by_unit"].get(unit_key, 0) + 1
+        
+        mark_store_dirty(store)
 
 def track_quick_action(action_name: str):
     """Track quick action button usage."""
-    analytics = load_analytics()
-    if "popular_quick_actions" not in analytics:
-        analytics["popular_quick_actions"] = {}
-    analytics["popular_quick_actions"][action_name] = analytics["popular_quick_actions"].get(action_name, 0) + 1
-    save_analytics(analytics)
+    store = get_analytics_store()
+    with store["lock"]:
+        analytics = store["data"]
+        if "popular_quick_actions" not in analytics:
+            analytics["popular_quick_actions"] = {}
+        analytics["popular_quick_actions"][action_name] = analytics["popular_quick_actions"].get(action_name, 0) + 1
+        mark_store_dirty(store)
 
 def get_analytics_summary() -> Dict:
     """Get a summary of analytics for display."""
-    analytics = load_analytics()
-    
-    # Calculate average response time
-    response_times = analytics.get("response_times", [])
-    avg_response = sum(response_times) / len(response_times) if response_times else 0
-    
-    # Get top topics
-    topics = analytics.get("questions_by_topic", {})
-    top_topics = sorted(topics.items(), key=lambda x: x[1], reverse=True)[:5]
-    
-    # Get usage last 7 days
-    daily = analytics.get("daily_usage", {})
-    today = datetime.now()
-    last_7_days = 0
-    for i in range(7):
-        day = (today - timedelta(days=i)).strftime("%Y-%m-%d")
-        last_7_days += daily.get(day, 0)
-    
-    return {
-        "total_messages": analytics.get("total_messages", 0),
-        "total_sessions": analytics.get("total_sessions", 1),
-        "avg_response_time": round(avg_response, 2),
-        "top_topics": top_topics,
-        "messages_last_7_days": last_7_days,
-        "popular_actions": sorted(
-            analytics.get("popular_quick_actions", {}).items(), 
-            key=lambda x: x[1], 
-            reverse=True
-        )[:3]
-    }
+    store = get_analytics_store()
+    with store["lock"]:
+        analytics = store["data"]
+        
+        # Calculate average response time
+        response_times = analytics.get("response_times", [])
+        avg_response = sum(response_times) / len(response_times) if response_times else 0
+        
+        # Get top topics
+        topics = analytics.get("questions_by_topic", {})
+        top_topics = heapq.nlargest(5, topics.items(), key=lambda x: x[1])
+        
+        # Get usage last 7 days
+        daily = analytics.get("daily_usage", {})
+        today = datetime.now()
+        last_7_days = 0
+        for i in range(7):
+            day = (today - timedelta(days=i)).strftime("%Y-%m-%d")
+            last_7_days += daily.get(day, 0)
+        
+        return {
+            "total_messages": analytics.get("total_messages", 0),
+            "total_sessions": analytics.get("total_sessions", 1),
+            "avg_response_time": round(avg_response, 2),
+            "top_topics": top_topics,
+            "messages_last_7_days": last_7_days,
+            "popular_actions": heapq.nlargest(
+                3,
+                analytics.get("popular_quick_actions", {}).items(),
+                key=lambda x: x[1]
+            )
+        }
 
 # Track session on first load (after analytics functions are defined)
 if "session_tracked" not in st.session_state:
     st.session_state.session_tracked = True
-    _analytics = load_analytics()
-    _analytics["total_sessions"] = _analytics.get("total_sessions", 0) + 1
-    save_analytics(_analytics)
+    _store = get_analytics_store()
+    with _store["lock"]:
+        _store["data"]["total_sessions"] = _store["data"].get("total_sessions", 0) + 1
+        mark_store_dirty(_store)
 
 # ==========================================
 # THREAD MANAGEMENT FUNCTIONS
@@ -1429,7 +1936,9 @@ def create_new_thread():
             "content": "Hello! 👋 Ready to continue learning Spanish? What would you like to practice today?"
         }],
         "created_at": datetime.now(),
-        "suggestions": []
+        "suggestions": [],
+        "user_message_count": 0,
+        "messages_appended": 1
     }
     
     st.session_state.current_thread_id = new_thread_id
@@ -1439,7 +1948,10 @@ def switch_thread(thread_id: str):
     """Switch to a different conversation thread."""
     st.session_state.current_thread_id = thread_id
     st.session_state.selected_message_index = None
-    save_threads_to_file()  # Persist current thread change
+
+def mark_thread_picked():
+    """Sidebar thread picker callback: keep the user's pick instead of resyncing it."""
+    st.session_state.thread_picked = True
 
 def delete_thread(thread_id: str):
     """Delete a conversation thread."""
@@ -1449,6 +1961,11 @@ def delete_thread(thread_id: str):
             st.session_state.current_thread_id = list(st.session_state.threads.keys())[0]
         save_threads_to_file()  # Persist deletion
 
+def iter_threads_newest_first():
+    """Iterate threads newest first. Threads are only ever appended, so dict
+    insertion order already matches creation time and no sort is needed."""
+    return reversed(st.session_state.threads.items())
+
 def get_current_thread():
     """Get the current active thread."""
     return st.session_state.threads[st.session_state.current_thread_id]
@@ -1458,9 +1975,31 @@ def update_thread_title(thread_id: str, first_user_message: str):
     if st.session_state.threads[thread_id]["title"].startswith("New Conversation"):
         st.session_state.threads[thread_id]["title"] = generate_thread_title(first_user_message)
 
+def build_message_preview(text: str) -> str:
+    """HTML-escaped, truncated preview of a message for the history panel."""
+    preview = html.escape(text[:HISTORY_PREVIEW_CHARS], quote=True)
+    return preview + "..." if len(text) > HISTORY_PREVIEW_CHARS else preview
+
+def append_thread_message(thread: Dict, role: str, content: str):
+    """Append a message to a thread, keeping only the last MAX_THREAD_MESSAGES."""
+    message = {
+        "role": role,
+        "content": content,
+        "clean": strip_suggestions(content)  # computed once, reused on every rerun
+    }
+    if role == "user":
+        thread["user_message_count"] = thread.get("user_message_count", 0) + 1
+        if HISTORY_PANEL_ENABLED:
+            # History panel fields, escaped and formatted once
+            message["preview"] = build_message_preview(content)
+            message["time_str"] = datetime.now().strftime("%H:%M")
+    thread["messages"].append(message)
+    # Keeps counting after trimming, so it identifies the thread's state for memoization
+    thread["messages_appended"] = thread.get("messages_appended", 0) + 1
+    del thread["messages"][:-MAX_THREAD_MESSAGES]
+
 def get_user_messages_with_time():
     """Get all user messages from current thread with timestamps."""
-    from datetime import timedelta
     current_thread = get_current_thread()
     user_messages = []
     
@@ -1471,16 +2010,19 @@ def get_user_messages_with_time():
             user_messages.append({
                 "index": idx,
                 "content": msg["content"],
-                "time": time_estimate
+                "time": time_estimate,
+                "preview": msg.get("preview") or build_message_preview(msg["content"]),
+                "time_str": msg.get("time_str") or time_estimate.strftime("%H:%M")
             })
     
     return user_messages
 
 # ==========================================
-# LOAD NOTION CONTENT ON FIRST RUN
+# LOAD NOTION CONTENT (SHARED CACHE)
 # ==========================================
+# Served from the global cache on every rerun; only hits Notion after the TTL
+st.session_state.contexto = get_weekly_content()
 if not st.session_state.context_loaded:
-    st.session_state.contexto = get_weekly_content()
     st.session_state.context_loaded = True
     st.session_state.last_sync = datetime.now()
 
@@ -1500,13 +2042,14 @@ def process_user_input(user_text: str, quick_action: str = None):
     current_thread = get_current_thread()
     
     # Update thread title if this is first user message
-    user_message_count = sum(1 for m in current_thread["messages"] if m["role"] == "user")
-    if user_message_count == 0:
+    if current_thread.get("user_message_count", 0) == 0:
         update_thread_title(st.session_state.current_thread_id, user_text)
     
     # Add user message
-    current_thread["messages"].append({"role": "user", "content": user_text})
+    append_thread_message(current_thread, "user", user_text)
     st.session_state.message_count += 1
+    with st.chat_message("user"):
+        st.markdown(user_text)
     
     # Track quick action if provided
     if quick_action:
@@ -1514,41 +2057,63 @@ def process_user_input(user_text: str, quick_action: str = None):
     
     # Get AI response with conversation history
     start_time = time.time()
-    with st.spinner("🤔 Thinking..."):
-        # Get messages before adding the current one (for history)
-        history_messages = current_thread["messages"][:-1]  # Exclude the just-added user message
-        
-        raw_response = get_ai_response(
-            user_text, 
-            st.session_state.contexto,
-            st.session_state.preferred_language,
-            st.session_state.custom_language,
-            conversation_history=history_messages
-        )
-        
-        # Extract router debug info
-        router_match = re.search(r'<!--ROUTER_DEBUG:([^|]+)\|([^>]+)-->', raw_response)
-        if router_match:
-            st.session_state.last_router_info = {
-                "complexity": router_match.group(1),
-                "model": router_match.group(2)
-            }
-            raw_response = re.sub(r'<!--ROUTER_DEBUG:[^>]+-->', '', raw_response)
-        else:
-            st.session_state.last_router_info = None
-        
-        # Extract suggestions
-        suggestions = re.findall(r'///\s*(.*)', raw_response)
-        suggestions = [s.strip() for s in suggestions if s.strip()][:3]
-        current_thread["suggestions"] = suggestions
-        
-        # Clean response
-        clean_response = re.sub(r'///.*', '', raw_response).strip()
+    # Get messages before adding the current one (for history)
+    # Only the window get_ai_response can use, excluding the just-added user message
+    history_messages = current_thread["messages"][-(HISTORY_WINDOW + 1):-1]
+    
+    # Show the reply as it streams in; the rerun after the turn redraws it in the history.
+    # The thinking note is replaced by the first streamed tokens.
+    with st.chat_message("assistant"):
+        stream_placeholder = st.empty()
+        stream_placeholder.caption("🤔 Thinking...")
+    
+    stream_state = {"last_flush": time.monotonic(), "chunks": 0}
+    
+    def show_partial_response(text: str):
+        # Coalesce deltas so the placeholder is redrawn at most ~12 times per second
+        stream_state["chunks"] += 1
+        now = time.monotonic()
+        if (now - stream_state["last_flush"] < STREAM_FLUSH_INTERVAL
+                and stream_state["chunks"] % STREAM_FLUSH_CHUNKS != 0):
+            return
+        stream_state["last_flush"] = now
+        stream_placeholder.markdown(strip_suggestions(text) + " ▌")
+    
+    raw_response = get_ai_response(
+        user_text, 
+        st.session_state.contexto,
+        st.session_state.preferred_language,
+        st.session_state.custom_language,
+        conversation_history=history_messages,
+        on_token=show_partial_response
+    )
+    
+    # Extract router debug info
+    router_match = re.search(r'<!--ROUTER_DEBUG:([^|]+)\|([^>]+)-->', raw_response)
+    if router_match:
+        st.session_state.last_router_info = {
+            "complexity": router_match.group(1),
+            "model": router_match.group(2)
+        }
+        raw_response = re.sub(r'<!--ROUTER_DEBUG:[^>]+-->', '', raw_response)
+    else:
+        st.session_state.last_router_info = None
+    
+    # Extract suggestions
+    suggestions = SUGGESTION_RE.findall(raw_response)
+    suggestions = [s.strip() for s in suggestions if s.strip()][:3]
+    current_thread["suggestions"] = suggestions
     
+    # Clean response
+    clean_response = strip_suggestions(raw_response)
+    
+    # Final flush so the complete reply is shown even if the last deltas were throttled
+    stream_placeholder.markdown(clean_response)
+
     response_time = time.time() - start_time
     
     # Add AI message
-    current_thread["messages"].append({"role": "assistant", "content": clean_response})
+    append_thread_message(current_thread, "assistant", clean_response)
     st.session_state.message_count += 1
     
     # Track analytics
@@ -1567,38 +2132,40 @@ if "debug_logs" not in st.session_state:
 # ==========================================
 # SIDEBAR
 # ==========================================
-try:
-    with st.sidebar:
+@st.fragment
+def render_sidebar():
+    """Sidebar controls. Widget interactions only rerun the sidebar unless they call st.rerun()."""
+    try:
         st.markdown("### 🎓 ProfeBot Control")
         
         # ===== CONVERSATIONS =====
         st.markdown("#### 💬 Conversations")
         
-        for thread_id, thread_data in sorted(
-            st.session_state.threads.items(), 
-            key=lambda x: x[1]["created_at"], 
-            reverse=True
-        ):
-            is_active = thread_id == st.session_state.current_thread_id
-            
-            col1, col2 = st.columns([4, 1])
-            
-            with col1:
-                if st.button(
-                    f"{'📌' if is_active else '💭'} {thread_data['title'][:20]}",
-                    key=f"thread_{thread_id}",
-                    use_container_width=True,
-                    type="primary" if is_active else "secondary"
-                ):
-                    if thread_id != st.session_state.current_thread_id:
-                        switch_thread(thread_id)
-                        st.rerun()
-            
-            with col2:
-                if len(st.session_state.threads) > 1:
-                    if st.button("🗑️", key=f"del_{thread_id}"):
-                        delete_thread(thread_id)
-                        st.rerun()
+        # One radio for all threads instead of two buttons per thread. The stable key
+        # keeps the widget across thread creates and renames; unless the user just
+        # picked a thread, it is synced to switches made elsewhere (mobile menu,
+        # new or deleted thread).
+        threads = st.session_state.threads
+        thread_ids = [thread_id for thread_id, _ in iter_threads_newest_first()]
+        current_id = st.session_state.current_thread_id
+        if not st.session_state.pop("thread_picked", False):
+            st.session_state.thread_picker = current_id
+        selected_thread = st.radio(
+            "Conversations",
+            options=thread_ids,
+            format_func=lambda thread_id: f"{'📌' if thread_id == current_id else '💭'} {threads[thread_id]['title'][:20]}",
+            key="thread_picker",
+            on_change=mark_thread_picked,
+            label_visibility="collapsed"
+        )
+        if selected_thread != st.session_state.current_thread_id:
+            switch_thread(selected_thread)
+            st.rerun()
+        
+        if len(threads) > 1:
+            if st.button("🗑️ Delete Conversation", use_container_width=True, key="btn_delete"):
+                delete_thread(st.session_state.current_thread_id)
+                st.rerun()
         
         st.caption(f"{len(st.session_state.threads)} conversation(s)")
         st.divider()
@@ -1639,41 +2206,36 @@ try:
             mode_label = "☀️ Day Mode" if st.session_state.dark_mode else "🌙 Night Mode"
             if st.button(mode_label, use_container_width=True, key="btn_dark"):
                 st.session_state.dark_mode = not st.session_state.dark_mode
-                save_threads_to_file()
                 st.rerun()
         
         # ===== EXPORT =====
         with st.expander("📥 Export Chat"):
-            current_thread = get_current_thread()
+            exports = get_conversation_exports()
             
-            txt_content = export_conversation_txt(current_thread["messages"])
             st.download_button(
                 "📄 TXT",
-                txt_content,
+                exports["txt"],
                 f"chat_{datetime.now().strftime('%Y%m%d_%H%M')}.txt",
                 "text/plain",
                 use_container_width=True
             )
             
-            md_content = export_conversation_md(current_thread["messages"])
             st.download_button(
                 "📝 Markdown",
-                md_content,
+                exports["md"],
                 f"chat_{datetime.now().strftime('%Y%m%d_%H%M')}.md",
                 "text/markdown",
                 use_container_width=True
             )
             
-            if DOCX_AVAILABLE:
-                docx_buffer = export_conversation_docx(current_thread["messages"])
-                if docx_buffer:
-                    st.download_button(
-                        "📘 Word",
-                        docx_buffer,
-                        f"chat_{datetime.now().strftime('%Y%m%d_%H%M')}.docx",
-                        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                        use_container_width=True
-                    )
+            if exports["docx"]:
+                st.download_button(
+                    "📘 Word",
+                    exports["docx"],
+                    f"chat_{datetime.now().strftime('%Y%m%d_%H%M')}.docx",
+                    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    use_container_width=True
+                )
         
         # ===== PROGRESS =====
         with st.expander("📈 My Progress"):
@@ -1749,102 +2311,31 @@ try:
         st.divider()
         st.markdown("[🏛️ HKU Spanish Dept](https://spanish.hku.hk/)", unsafe_allow_html=True)
 
-except Exception as e:
-    st.error(f"Sidebar error: {e}")
+    except Exception as e:
+        st.error(f"Sidebar error: {e}")
+
+with st.sidebar:
+    render_sidebar()
 
 # ==========================================
 # FLOATING MESSAGE HISTORY PANEL
 # ==========================================
-user_messages = get_user_messages_with_time()
-
-# Build history HTML with proper escaping
-history_items_html = []
-if user_messages:
-    for msg_data in user_messages:  # Oldest first, newest at bottom
-        # Escape HTML characters in message content
-        msg_content = msg_data["content"][:80]
-        msg_content = msg_content.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&#39;")
-        msg_preview = msg_content + "..." if len(msg_data["content"]) > 80 else msg_content
-        time_str = msg_data["time"].strftime("%H:%M")
-        idx = msg_data["index"]
-        
-        history_items_html.append(f'''<div class="history-item" data-idx="{idx}"><div class="history-item-time">🕐 {time_str}</div><div class="history-item-text">{msg_preview}</div></div>''')
-
-history_content = "".join(history_items_html) if history_items_html else '<div class="empty-history">No messages yet.<br>Start chatting!</div>'
-
-# Get dark mode state for styling - HKU Colors
-is_dark = st.session_state.get('dark_mode', False)
-panel_bg = "rgba(22, 27, 34, 0.92)" if is_dark else "rgba(255, 255, 255, 0.92)"
-history_text_color = "#f0f6fc" if is_dark else "#24292f"
-history_text_secondary = "#8b949e" if is_dark else "#57606a"
-history_border_color = "rgba(0, 168, 107, 0.3)" if is_dark else "rgba(14, 66, 54, 0.3)"
-history_item_bg = "rgba(33, 38, 45, 0.9)" if is_dark else "rgba(246, 248, 250, 0.9)"
-history_item_hover = "rgba(0, 168, 107, 0.15)" if is_dark else "rgba(14, 66, 54, 0.1)"
-history_accent_color = "#00A86B" if is_dark else "#0e4236"
-
-# HTML for the panel (will be rendered with st.markdown)
-history_panel_html = f'''
-<div class="message-history-panel" style="
-    position: fixed;
-    right: 20px;
-    top: 80px;
-    width: 280px;
-    max-height: calc(100vh - 120px);
-    min-height: 80px;
-    background: {panel_bg};
-    backdrop-filter: blur(12px);
-    -webkit-backdrop-filter: blur(12px);
-    border: 1px solid {history_border_color};
-    border-radius: 16px;
-    padding: 15px;
-    overflow-y: auto;
-    box-shadow: 0 8px 32px rgba(0,0,0,0.2);
-    z-index: 999;
-    font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-">
-    <div style="font-size: 1rem; font-weight: 600; margin-bottom: 15px; padding-bottom: 10px; border-bottom: 2px solid {history_accent_color}; color: {history_text_color};">
-        📝 Your Messages <span style="font-size: 0.75rem; color: {history_text_secondary}; font-weight: normal;">({len(user_messages)})</span>
-    </div>
-    {history_content}
-</div>
-<style>
-    .message-history-panel .history-item {{
-        padding: 12px;
-        margin: 8px 0;
-        background: {history_item_bg};
-        border-left: 3px solid {history_accent_color};
-        border-radius: 8px;
-        cursor: pointer;
-        transition: all 0.2s ease;
-        font-size: 0.85rem;
-    }}
-    .message-history-panel .history-item:hover {{
-        background: {history_item_hover};
-        transform: translateX(-3px);
-        box-shadow: 0 4px 12px rgba(0,0,0,0.2);
-    }}
-    .message-history-panel .history-item-time {{
-        font-size: 0.7rem;
-        color: {history_text_secondary};
-        margin-bottom: 4px;
-    }}
-    .message-history-panel .history-item-text {{
-        color: {history_text_color};
-        line-height: 1.4;
-        display: -webkit-box;
-        -webkit-line-clamp: 3;
-        -webkit-box-orient: vertical;
-        overflow: hidden;
-    }}
-    .message-history-panel .empty-history {{
-        text-align: center;
-        color: {history_text_secondary};
-        font-size: 0.85rem;
-        padding: 20px;
-        font-style: italic;
-    }}
-</style>
-'''
+@st.cache_data(show_spinner=False)
+def build_history_panel_html(user_messages: List[Dict]) -> str:
+    """Build the floating history panel markup; styling comes from the theme CSS injected once per theme."""
+    # Oldest first, newest at bottom; previews are escaped and truncated when the message is appended
+    history_content = "".join(
+        f'<div class="history-item" data-idx="{msg_data["index"]}"><div class="history-item-time">🕐 {msg_data["time_str"]}</div><div class="history-item-text">{msg_data["preview"]}</div></div>'
+        for msg_data in user_messages
+    ) or '<div class="empty-history">No messages yet.<br>Start chatting!</div>'
+
+    return (
+        '<div class="message-history-panel">'
+        f'<div class="history-panel-title">📝 Your Messages <span class="history-count">({len(user_messages)})</span></div>'
+        f'{history_content}'
+        '</div>'
+    )
+
 
 # ==========================================
 # INTERACTIVE QUIZ SYSTEM
@@ -2006,7 +2497,7 @@ def render_interactive_quiz(quiz_data: Dict, quiz_id: str):
                 q_key = get_quiz_answer_key(q_index, q['number'])
                 if q_key in st.session_state.quiz_answers:
                     del st.session_state.quiz_answers[q_key]
-            st.rerun()
+            st.rerun(scope="fragment")
 
 
 def format_quiz_answers_for_submission(quiz_data: Dict, quiz_id: str) -> str:
@@ -2072,8 +2563,13 @@ components.html("""
             });
         }
     }
-    // Run on load and on resize
+    // Run on load and on resize; keep a single resize handler on the parent window
+    // even if Streamlit remounts this iframe
     hideMobileMenu();
+    if (window.parent._profebotHideMobileMenu) {
+        window.parent.removeEventListener('resize', window.parent._profebotHideMobileMenu);
+    }
+    window.parent._profebotHideMobileMenu = hideMobileMenu;
     window.parent.addEventListener('resize', hideMobileMenu);
     // Also run after a short delay to ensure Streamlit has rendered
     setTimeout(hideMobileMenu, 500);
@@ -2084,11 +2580,7 @@ components.html("""
 # Mobile menu expander (hidden on desktop via JavaScript above)
 with st.expander("📱 Menu", expanded=False):
     st.markdown("#### 💬 Conversations")
-    for thread_id, thread_data in sorted(
-        st.session_state.threads.items(), 
-        key=lambda x: x[1]["created_at"], 
-        reverse=True
-    )[:5]:  # Show only 5 most recent on mobile
+    for thread_id, thread_data in islice(iter_threads_newest_first(), 5):  # Show only 5 most recent on mobile
         is_active = thread_id == st.session_state.current_thread_id
         if st.button(
             f"{'📌' if is_active else '💭'} {thread_data['title'][:25]}",
@@ -2121,14 +2613,56 @@ with st.expander("📱 Menu", expanded=False):
     mode_label = "☀️ Day Mode" if st.session_state.dark_mode else "🌙 Night Mode"
     if st.button(mode_label, use_container_width=True, key="mobile_btn_dark"):
         st.session_state.dark_mode = not st.session_state.dark_mode
-        save_threads_to_file()
         st.rerun()
 
 # Get current thread
 current_thread = get_current_thread()
 
+def close_open_fence(text: str) -> str:
+    """Close a fenced code block left open so it cannot swallow the markup of later messages."""
+    fence = None
+    for match in MARKDOWN_FENCE_RE.finditer(text):
+        run, rest = match.groups()
+        if fence is None:
+            fence = run
+        elif run[0] == fence[0] and len(run) >= len(fence) and not rest.strip():
+            fence = None
+    return text if fence is None else f"{text}\n{fence}"
+
+def format_history_message(idx: int, message: Dict) -> str:
+    """Format a past message as a markdown-bearing HTML card for the batched history."""
+    role = "user" if message["role"] == "user" else "assistant"
+    # Raw HTML is enabled for the batch, so message text is escaped wholesale
+    clean_text = close_open_fence(html.escape(get_message_text(message), quote=False))
+    # Blank lines around the text let markdown render inside the wrapper div
+    return f'<div class="chat-msg chat-msg-{role}" id="msg_{idx}">\n\n{clean_text}\n\n</div>\n\n'
+
 # Display chat history with IDs for navigation
-for idx, message in enumerate(current_thread["messages"]):
+@st.fragment
+def render_chat_history():
+    """Render the current thread. Widget interactions inside (quiz answers) only rerun this fragment."""
+    current_thread = get_current_thread()
+    messages = current_thread["messages"]
+    
+    # Past turns are static, so they go out as one markdown block instead of
+    # one chat_message container each; only the newest message gets a widget
+    first_visible = max(0, len(messages) - 1 - CHAT_VISIBLE_TAIL)
+    if first_visible and st.toggle(
+        f"Show {first_visible} earlier messages",
+        key=f"show_earlier_{st.session_state.current_thread_id}"
+    ):
+        first_visible = 0
+    if len(messages) - 1 > first_visible:
+        st.markdown(
+            "".join(
+                format_history_message(idx, messages[idx])
+                for idx in range(first_visible, len(messages) - 1)
+            ),
+            unsafe_allow_html=True
+        )
+    
+    idx = len(messages) - 1
+    message = messages[idx]
     tipo = "user" if message["role"] == "user" else "assistant"
     
     # Add anchor ID for user messages with scroll margin
@@ -2136,12 +2670,10 @@ for idx, message in enumerate(current_thread["messages"]):
         st.markdown(f'<div id="msg_{idx}" style="scroll-margin-top: 100px;"></div>', unsafe_allow_html=True)
     
     with st.chat_message(tipo):
-        clean_text = re.sub(r'///.*', '', message["content"]).strip()
+        clean_text = get_message_text(message)
         
-        # Check if this is the last assistant message and contains a quiz
-        is_last_assistant = (tipo == "assistant" and idx == len(current_thread["messages"]) - 1)
-        
-        if is_last_assistant and not st.session_state.get('quiz_submitted', False):
+        # Check if the last message is from the assistant and contains a quiz
+        if tipo == "assistant" and not st.session_state.get('quiz_submitted', False):
             # Try to parse as quiz
             quiz_data = parse_quiz_from_response(clean_text)
             
@@ -2159,6 +2691,23 @@ for idx, message in enumerate(current_thread["messages"]):
             # Regular message display
             st.markdown(clean_text)
 
+render_chat_history()
+
+# Handle a prompt queued by a quick action or suggestion button (rendering it
+# from inside the button's column would squeeze the new turn into that column)
+if st.session_state.get('pending_prompt'):
+    pending_text, pending_action = st.session_state.pending_prompt
+    st.session_state.pending_prompt = None
+    process_user_input(pending_text, quick_action=pending_action)
+    st.rerun()
+
+# Chat input (pinned to the bottom; handled here so the new turn renders right under the history)
+if prompt := st.chat_input("Type your question here... (any language)", key="main_chat_input"):
+    process_user_input(prompt)
+    # Redraw the turn inside the history fragment and refresh the sidebar
+    # (message count, exports), which were built earlier in this run
+    st.rerun()
+
 # Handle pending quiz submission
 if st.session_state.get('pending_quiz_submission'):
     submission_text = st.session_state.pending_quiz_submission
@@ -2182,7 +2731,7 @@ if current_thread["suggestions"] and len(current_thread["messages"]) > 1:
                     key=f"sugg_{st.session_state.current_thread_id}_{st.session_state.message_count}_{i}",
                     use_container_width=True
                 ):
-                    process_user_input(suggestion)
+                    st.session_state.pending_prompt = (suggestion, None)
                     st.rerun()
 
 # Display router debug info (small caption)
@@ -2194,50 +2743,58 @@ if hasattr(st.session_state, 'last_router_info') and st.session_state.last_route
         model_emoji = "🚀" if "DeepSeek" in router_info["model"] else "🧠"
         st.caption(f"{model_emoji} Router: {router_info['complexity']} → Using {router_info['model']}")
 
-# Quick action buttons - only show after first user message
-user_message_count = sum(1 for m in current_thread["messages"] if m["role"] == "user")
-if user_message_count > 0:
-    st.divider()
-    st.caption("⚡ **Quick Actions:**")
-
-    c0, c1, c2 = st.columns(3)
-
-    with c0:
-        st.markdown('<div class="quick-action-btn">', unsafe_allow_html=True)
-        if st.button("📋 Tasks!", use_container_width=True, key="qa_tasks"): 
-            process_user_input("""CMD_TASKS: I want to do a practice task. Please respond in my preferred language (as set in my language preferences) and ask me which type of task I'd like to do:
+# Prompts sent by the quick action buttons, keyed by their analytics label
+QUICK_ACTION_PROMPTS = {
+    "Tasks": """CMD_TASKS: I want to do a practice task. Please respond in my preferred language (as set in my language preferences) and ask me which type of task I'd like to do:
 
 1. **Reading Task** - A 250-word text with paragraph structure, using simple connectors, with 8 multiple choice comprehension questions
 2. **Conversation Task** - Simple conversation questions to practice speaking. Instructions should be in my preferred language.
 3. **Grammar & Vocabulary Task** - Exercises based on the activity bank. Instructions should be in my preferred language.
 
-Also ask me which unit I want to practice. Wait for my response before creating the task.""", quick_action="Tasks")
-            st.rerun()
-        st.markdown('</div>', unsafe_allow_html=True)
+Also ask me which unit I want to practice. Wait for my response before creating the task.""",
+    "Quiz": """CMD_QUIZ: I want to take a quiz. Please ask me what topic or vocabulary I want to practice from the active units. 
 
-    with c1:
-        st.markdown('<div class="quick-action-btn">', unsafe_allow_html=True)
-        if st.button("📝 Quiz", use_container_width=True, key="qa_quiz"): 
-            process_user_input("""CMD_QUIZ: I want to take a quiz. Please ask me what topic or vocabulary I want to practice from the active units. 
+IMPORTANT: When you give me the quiz questions, do NOT provide the answers. Wait for me to respond with my answers first, then give me feedback on each one.""",
+    "Explain & Examples": "CMD_EXPLAIN_MORE: Please elaborate a bit more on what we were just discussing. Go slightly deeper into the topic, provide additional context and give me 3 practical examples, but keep it at my level.",
+}
 
-IMPORTANT: When you give me the quiz questions, do NOT provide the answers. Wait for me to respond with my answers first, then give me feedback on each one.""", quick_action="Quiz")
-            st.rerun()
-        st.markdown('</div>', unsafe_allow_html=True)
+# Quick action buttons - only show after first user message
+@st.fragment
+def render_quick_actions():
+    """Quick action row; isolated so it is not rebuilt by other widget interactions."""
+    current_thread = get_current_thread()
+    if current_thread.get("user_message_count", 0) > 0:
+        st.divider()
+        st.caption("⚡ **Quick Actions:**")
 
-    with c2:
-        st.markdown('<div class="quick-action-btn">', unsafe_allow_html=True)
-        if st.button("🧐 Explain & Examples", use_container_width=True, key="qa_explain"): 
-            process_user_input("CMD_EXPLAIN_MORE: Please elaborate a bit more on what we were just discussing. Go slightly deeper into the topic, provide additional context and give me 3 practical examples, but keep it at my level.", quick_action="Explain & Examples")
-            st.rerun()
-        st.markdown('</div>', unsafe_allow_html=True)
+        c0, c1, c2 = st.columns(3)
 
-# Chat input
-if prompt := st.chat_input("Type your question here... (any language)", key="main_chat_input"):
-    process_user_input(prompt)
-    st.rerun()
+        with c0:
+            st.markdown('<div class="quick-action-btn">', unsafe_allow_html=True)
+            if st.button("📋 Tasks!", use_container_width=True, key="qa_tasks"): 
+                st.session_state.pending_prompt = (QUICK_ACTION_PROMPTS["Tasks"], "Tasks")
+                st.rerun()
+            st.markdown('</div>', unsafe_allow_html=True)
+
+        with c1:
+            st.markdown('<div class="quick-action-btn">', unsafe_allow_html=True)
+            if st.button("📝 Quiz", use_container_width=True, key="qa_quiz"): 
+                st.session_state.pending_prompt = (QUICK_ACTION_PROMPTS["Quiz"], "Quiz")
+                st.rerun()
+            st.markdown('</div>', unsafe_allow_html=True)
+
+        with c2:
+            st.markdown('<div class="quick-action-btn">', unsafe_allow_html=True)
+            if st.button("🧐 Explain & Examples", use_container_width=True, key="qa_explain"): 
+                st.session_state.pending_prompt = (QUICK_ACTION_PROMPTS["Explain & Examples"], "Explain & Examples")
+                st.rerun()
+            st.markdown('</div>', unsafe_allow_html=True)
 
-# Temporarily disabled: Inject floating message history panel
-# st.markdown(history_panel_html, unsafe_allow_html=True)
+render_quick_actions()
+
+# Inject floating message history panel (temporarily disabled via HISTORY_PANEL_ENABLED)
+if HISTORY_PANEL_ENABLED:
+    st.markdown(build_history_panel_html(get_user_messages_with_time()), unsafe_allow_html=True)
 
 # Temporarily disabled: Inject JavaScript for click handlers
 # scroll_js = f'''
@@ -2246,5 +2803,3 @@ if prompt := st.chat_input("Type your question here... (any language)", key="mai
 # </script>
 # '''
 # components.html(scroll_js, height=0, scrolling=False)
-
-